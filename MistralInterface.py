@@ -1,4 +1,8 @@
+import hashlib
 import json
+import os
+import random
+import sqlite3
 import threading
 import textwrap
 import re
@@ -6,17 +10,30 @@ import warnings
 import time  # Ensure time is imported
 from mistralai import SDKError, Mistral
 from key import MistraAIKey as api_key
-from typing import Any, cast  # added import
+from typing import Any, Optional, cast  # added import
 
 warnings.filterwarnings("ignore")
 
 class MistralInterface:
-    def __init__(self):
+    def __init__(self, cache_path: Optional[str] = "llm_cache.db3"):
         """
         Initialize the MistralInterface class.
         The class is responsible for managing sentiment analysis using a language model.
+        Input:
+        - cache_path: sqlite file where successful responses are cached,
+            keyed by prompt hash. Pass None to disable the cache.
         """
-        # Removed cache-related variables
+        # Persistent prompt -> response cache, shared by all worker threads.
+        # Writes are serialized with a lock because the connection is shared.
+        self._cache: Optional[sqlite3.Connection] = None
+        self._cacheLock = threading.Lock()
+        if cache_path:
+            self._cache = sqlite3.connect(cache_path, check_same_thread=False)
+            self._cache.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, success INTEGER NOT NULL)"
+            )
+            self._cache.commit()
         # Using a semaphore for thread-safe access to the LLM
         # Limiting the number of concurrent requests to 6, because
         # Mistral has a limit of 6 concurrent requests per API key
@@ -24,6 +41,70 @@ class MistralInterface:
         # Initialize the Mistral client
         self.genAI_Client = Mistral(api_key=api_key)
 
+    def _cacheGet(self, key: str) -> Optional[tuple[str, bool]]:
+        """Return the cached (response, success) for key, or None on a miss."""
+        if self._cache is None:
+            return None
+        with self._cacheLock:
+            row = self._cache.execute(
+                "SELECT response, success FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], bool(row[1])
+
+    def _cachePut(self, key: str, response: str, success: bool) -> None:
+        """Store a response in the cache."""
+        if self._cache is None:
+            return
+        with self._cacheLock:
+            self._cache.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, success) VALUES (?, ?, ?)",
+                (key, response, int(success)),
+            )
+            self._cache.commit()
+
+    @staticmethod
+    def _backoffDelay(retry_counter: int, error: Optional[Exception] = None) -> float:
+        """
+        Compute how long to wait before the next attempt.
+        A Retry-After header sent with the error takes precedence; otherwise
+        an exponential backoff with full jitter is used, so concurrent workers
+        hitting a rate limit do not retry in lockstep.
+        """
+        raw_response = getattr(error, "raw_response", None)
+        headers = getattr(raw_response, "headers", None)
+        if headers is not None:
+            retry_after = headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return max(0.0, float(retry_after))
+                except ValueError:
+                    pass
+        return random.uniform(0, min(8.0, 0.25 * (2 ** retry_counter)))
+
+    @staticmethod
+    def _extractContent(result: Any) -> Optional[str]:
+        """
+        Safely extract the message content from a chat completion,
+        supporting both SDK objects and plain dicts.
+        Return None if no content can be found.
+        """
+        try:
+            # Try object-style access first
+            choices = getattr(result, "choices", None)
+            if not choices and isinstance(result, dict):
+                # fallback to dict-style access
+                choices = result.get("choices")
+            if choices and len(choices) > 0:
+                first = choices[0]
+                message = getattr(first, "message", None) if not isinstance(first, dict) else first.get("message")
+                if message:
+                    return getattr(message, "content", None) if not isinstance(message, dict) else message.get("content")
+        except Exception:
+            pass
+        return None
+
     def invokeLLM(self,
         _prompt: str,
         _format: str = "text",
@@ -39,13 +120,21 @@ class MistralInterface:
         Return:
         - a tuple containing the LLM response and a boolean indicating
             if the invocation was successful.
+        Successful responses are cached, so repeating a prompt with the same
+        model, temperature and format does not call the API again.
         """
         response: str = ""
         success: bool = False
         _model: str = "mistral-large-latest"
 #        _model: str = "mistral-small-latest"
+        key = hashlib.sha256(f"{_model}|{_temperature}|{_format}|{_prompt}".encode("utf-8")).hexdigest()
+        cached = self._cacheGet(key)
+        if cached is not None:
+            return cached
         retry_counter: int = 0
         while retry_counter < attempts:
+            # Hold a concurrency slot for the HTTP call only; content
+            # extraction and backoff sleeps run with the permit released
             try:
                 with self.llmSemaphore:
                     # Cast the response_format dict to Any to satisfy the type checker
@@ -55,34 +144,45 @@ class MistralInterface:
                         messages=[{"role": "user", "content": _prompt }],
                         response_format=cast(Any, {"type" : _format})
                     )
-                # Safely extract content, supporting both SDK objects and plain dicts
-                content = None
-                try:
-                    # Try object-style access first
-                    choices = getattr(result, "choices", None)
-                    if not choices and isinstance(result, dict):
-                        # fallback to dict-style access
-                        choices = result.get("choices")
-                    if choices and len(choices) > 0:
-                        first = choices[0]
-                        message = getattr(first, "message", None) if not isinstance(first, dict) else first.get("message")
-                        if message:
-                            content = getattr(message, "content", None) if not isinstance(message, dict) else message.get("content")
-                except Exception:
-                    content = None
-
-                if content:
-                    response = content.strip()
-                    success = True
-                    break
-                else:
-                    # Treat missing content as transient failure and retry
-                    retry_counter += 1
-                    time.sleep(0.15 * retry_counter)
             except SDKError as e:
                 retry_counter += 1
-                time.sleep(0.15 * retry_counter)  # Exponential backoff
+                if retry_counter < attempts:
+                    time.sleep(self._backoffDelay(retry_counter, e))
+                continue
             except Exception as e:
                 print(f"Unexpected error occurred: {e}")
                 break
+
+            content = self._extractContent(result)
+            if content:
+                response = content.strip()
+                success = True
+                break
+            # Treat missing content as transient failure and retry
+            retry_counter += 1
+            if retry_counter < attempts:
+                time.sleep(self._backoffDelay(retry_counter))
+        if success:
+            self._cachePut(key, response, success)
         return response, success
+
+    def submitBatch(self, path: str, model: str = "mistral-large-latest") -> str:
+        """
+        Upload a batch input JSONL and start a chat completion batch job.
+        Input:
+        - path: the JSONL file with one request per line.
+        - model: the model used for every request in the batch.
+        Return:
+        - the id of the created batch job.
+        """
+        with open(path, "rb") as fh:
+            uploaded = self.genAI_Client.files.upload(
+                file={"file_name": os.path.basename(path), "content": fh},
+                purpose="batch",
+            )
+        job = self.genAI_Client.batch.jobs.create(
+            input_files=[uploaded.id],
+            model=model,
+            endpoint="/v1/chat/completions",
+        )
+        return job.id
@@ -6,41 +6,54 @@ from the Mistral batch run (e.g. `acc803eb-...jsonl`). Matches records by
 `custom_id`. For responses answering "no" (no morphological connection),
 asks the human to confirm. For confirmed pairs, finds matching rows in
 `relations_italian.db3` where `derived_term` equals the derived form and
-prints SQL DELETE statements (dry-run only).
+writes the SQL DELETE statements (dry-run by default, see --apply).
 
 Usage:
     python fix_relations_cleanup.py \
         --input dictionaryCheckBatch.jsonl \
         --output acc803eb-76b4-49d9-a0ee-c6c4e0b0efb4.jsonl \
-        [--db relations_italian.db3] [--yes]
+        [--db relations_italian.db3] [--yes] [--verbose] [--apply]
 
 Options:
-    --yes    Skip interactive confirmation and accept all 'no' answers
-
-This script will NOT execute deletes by default. It prints what would be
-deleted and saves a small JSON file `to_delete.json` containing the pairs.
+    --yes      Skip interactive confirmation and accept all 'no' answers
+    --verbose  Print every DELETE statement
+    --apply    Execute the deletes in a single transaction
+
+By default this is a dry-run: the DB is opened read-only, nothing is
+deleted, and the DELETE statements are saved to `deletions.sql` so they can
+be reviewed and run by hand. With --apply the same statements are executed
+on the DB.
 """
 from __future__ import annotations
 
 import argparse
-import json
+import re
 import sqlite3
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+try:
+    # orjson is optional; it parses large batch files several times faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Extracts derived and root terms from prompts of the form
+# "... La parola '<derived>' ... con il lemma '<root>'?"
+_PROMPT_RE = re.compile(r"La parola '([^']*)'.*?con il lemma '([^']*)'", re.DOTALL)
 
 
-def read_jsonl(path: Path) -> List[dict]:
-    data = []
-    with path.open("r", encoding="utf-8") as f:
+def read_jsonl(path: Path) -> Iterator[dict]:
+    # Yield records one at a time so large batch files are never fully loaded
+    # Both parsers accept UTF-8 bytes, so lines are not decoded first
+    with path.open("rb") as f:
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
-            data.append(json.loads(line))
-    return data
+            yield json_loads(line)
 
 
-def build_input_map(input_records: List[dict]) -> Dict[str, dict]:
+def build_input_map(input_records: Iterable[dict]) -> Dict[str, dict]:
     # Map custom_id -> input record
     m = {}
     for r in input_records:
@@ -78,6 +91,8 @@ def main() -> None:
     p.add_argument("--output", required=True, help="Output JSONL from model")
     p.add_argument("--db", default="relations_italian.db3", help="Path to sqlite DB")
     p.add_argument("--yes", action="store_true", help="Assume confirmation for all 'no' answers")
+    p.add_argument("--verbose", action="store_true", help="Print every DELETE statement")
+    p.add_argument("--apply", action="store_true", help="Execute the deletes on the DB instead of a dry-run")
     args = p.parse_args()
 
     input_path = Path(args.input)
@@ -91,20 +106,18 @@ def main() -> None:
     if not db_path.exists():
         raise SystemExit(f"DB file not found: {db_path}")
 
-    print("Reading input and output JSONL...")
-    inputs = read_jsonl(input_path)
-    outputs = read_jsonl(output_path)
-
-    input_map = build_input_map(inputs)
+    print("Reading input JSONL...")
+    input_map = build_input_map(read_jsonl(input_path))
 
     # Collect confirmed deletions: derived_term -> root_term
     to_delete: Dict[str, str] = {}
 
-    print(f"Found {len(outputs)} outputs to check")
+    print("Checking outputs JSONL...")
 
     counter: int = 0
 
-    for out in outputs:
+    for out in read_jsonl(output_path):
+        counter += 1
         cid = out.get("custom_id")
         if cid is None:
             continue
@@ -113,23 +126,13 @@ def main() -> None:
             print(f"Warning: no input record for custom_id={cid}")
             continue
 
-        # Extract derived term. The template to find is "La parola '<derived>'
-        index = in_rec["body"]["messages"][0]["content"].find("La parola '")
-        if index == -1:
-            print(f"Warning: couldn't find derived term in input for custom_id={cid}")
+        # Extract derived and root terms in a single pass over the prompt
+        content = in_rec["body"]["messages"][0]["content"]
+        m = _PROMPT_RE.search(content)
+        if not m:
+            print(f"Warning: couldn't find derived/root terms in input for custom_id={cid}")
             continue
-        # crude extraction of derived term between quotes
-        start = index + len("La parola '")  
-        end = in_rec["body"]["messages"][0]["content"].find("'", start)
-        derived = in_rec["body"]["messages"][0]["content"][start:end]
-        # Extract root term. The template to find is "con il lemma '<root>'?"
-        index = in_rec["body"]["messages"][0]["content"].find("con il lemma '")
-        if index == -1:
-            print(f"Warning: couldn't find root term in input for custom_id={cid}")
-            continue    
-        start = index + len("con il lemma '")
-        end = in_rec["body"]["messages"][0]["content"].find("'", start)
-        root = in_rec["body"]["messages"][0]["content"][start:end]
+        derived, root = m.group(1), m.group(2)
 
         if not derived or not root:
             # fallback: try to parse from a 'question' field
@@ -159,50 +162,92 @@ def main() -> None:
             if confirm:
                 to_delete[derived] = root
 
+    print(f"Checked {counter} outputs")
+
     if not to_delete:
         print("No confirmed deletions. Exiting.")
         return
 
-    # Connect DB and show matches
-    conn = sqlite3.connect(str(db_path))
+    # Connect DB and show matches. A dry-run opens the DB read-only, so it
+    # takes no write lock (relationsBuilder can keep writing) and any
+    # accidental write fails loudly; the temp table below lives in memory
+    if args.apply:
+        conn = sqlite3.connect(str(db_path))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    else:
+        conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=268435456")
 
-    print("\nDry-run: the following matches were found in DB for the confirmed derived terms:")
+    mode = "Apply" if args.apply else "Dry-run"
+    print(f"\n{mode}: looking up DB matches for the confirmed derived terms:")
     deletions: List[Tuple[str, str, int]] = []  # derived, root, derived_forms.id
 
-    for derived, root in to_delete.items():
-        # find the row with the root term
-        root_row = conn.execute("SELECT id FROM words WHERE lemma = ? COLLATE NOCASE", (root,)).fetchone()
-        if not root_row:
+    # Resolve all confirmed pairs with one query: load them into a temp
+    # table and join it against words and derived_forms. Only the rejected
+    # derived form of each root is selected, not its sibling forms. The
+    # indexes come from relationsBuilder.ensure_db; on older DBs without
+    # them SQLite builds automatic indexes for the join
+    conn.execute("CREATE TEMP TABLE todo (derived TEXT COLLATE NOCASE, root TEXT COLLATE NOCASE)")
+    conn.executemany("INSERT INTO todo (derived, root) VALUES (?, ?)", to_delete.items())
+    rows = conn.execute(
+        """
+        SELECT t.derived, t.root, w.id AS root_id, df.id AS df_id
+        FROM todo t
+        LEFT JOIN words w ON w.lemma = t.root COLLATE NOCASE
+        LEFT JOIN derived_forms df ON df.lemma_id = w.id AND df.form = t.derived COLLATE NOCASE
+        ORDER BY t.rowid, df.id
+        """
+    ).fetchall()
+
+    for r in rows:
+        derived, root = r["derived"], r["root"]
+        if r["root_id"] is None:
             print(f"  - No DB row found with lemma='{root}' in words")
             continue
-        root_id = root_row[0]
-        # now find matching derived forms
-        derived_rows = conn.execute("SELECT id, form FROM derived_forms WHERE lemma_id = ? COLLATE NOCASE", (root_id,)).fetchall()
-        if not derived_rows:
-            print(f"  - No DB rows found with derived form='{derived}' for root lemma_id={root_id}")
+        if r["df_id"] is None:
+            print(f"  - No DB rows found with derived form='{derived}' for root lemma_id={r['root_id']}")
             continue
-        # put derived_rows in the deletions list
-        for r in derived_rows:
-            # r: id, form
-            df_id = r[0]
-            deletions.append((derived, root, df_id))
+        deletions.append((derived, root, r["df_id"]))
 
     if not deletions:
-        print("\nNo rows to delete (dry-run). Exiting.")
+        print(f"\nNo rows to delete ({mode.lower()}). Exiting.")
         return
 
-    print("\nDry-run summary: the following DELETE statements would be executed:")
-    with open("deletions.sql", "w", encoding="utf-8") as sql_file:
-        for derived, root, df_id in deletions:
-            print(f"  DELETE FROM derived_forms WHERE id = {df_id};  -- form='{derived}' expected_root='{root}'")
-            sql_file.write(f"DELETE FROM derived_forms WHERE id = {df_id};  -- form='{derived}' expected_root='{root}'\n")
+    lines = [
+        f"DELETE FROM derived_forms WHERE id = {df_id};  -- form='{derived}' expected_root='{root}'"
+        for derived, root, df_id in deletions
+    ]
+    verb = "will be" if args.apply else "would be"
+    if args.verbose:
+        print(f"\n{mode} summary: the following DELETE statements {verb} executed:")
+        print("\n".join(f"  {line}" for line in lines))
+    else:
+        print(f"\n{mode} summary: {len(lines)} DELETE statements {verb} executed (use --verbose to list them)")
+    sql_path = Path("deletions.sql")
+    sql_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    print(f"\nSaved DELETE statements to {sql_path}")
+
+    if args.apply:
+        # All deletes run in a single transaction. Each one is also matched
+        # on the rejected form, so a row can never be removed unless its form
+        # is exactly the one the model and the human rejected
+        with conn:
+            cur = conn.executemany(
+                "DELETE FROM derived_forms WHERE id = ? AND form = ? COLLATE NOCASE",
+                [(df_id, derived) for derived, _, df_id in deletions],
+            )
+        print(f"Deleted {cur.rowcount} rows from {db_path}")
+        return
 
-    print(f"\nSaved dry-run report and pairs to {sql_file.name}")
     print("You can use sqlite3 to execute the DELETE statements following this procedure:\n")
     print("1) Make a backup copy of your database file.")
     print("2) Open sqlite3 shell: sqlite3 relations_italian.db3")
     print("3) Read and execute the SQL file: .read deletions.sql")
+    print("Alternatively, rerun this script with --apply.")
 
 if __name__ == "__main__":
     main()
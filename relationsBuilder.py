@@ -6,29 +6,47 @@ Changes made:
 - code reorganised into small functions
 - added a CLI `main()` that accepts an optional start index and chunk size
   (defaults: start=0, chunk_size=5)
+- chunks are sent to the LLM concurrently (up to 6 in flight, matching the
+  Mistral per-key limit); database writes stay on the main thread
+- nouns already present in the database are skipped, so an interrupted
+  run can simply be restarted
+- batch mode: `--emit-batch` writes the prompts to a Mistral batch JSONL
+  (optionally submitting it with `--submit`) and `--consume-batch` loads
+  the downloaded batch output into the database
 
 Usage example:
     python relationsBuilder.py --start 10 --chunk-size 8
+    python relationsBuilder.py --emit-batch nounsBatch.jsonl --submit
+    python relationsBuilder.py --consume-batch <batch-output>.jsonl
 
 The script preserves the original behaviour but resets per-chunk results
 so previously processed lemmas are not repeatedly re-inserted.
 """
 
 import argparse
+import functools
 import json
+import re
 import sqlite3
-from typing import Dict, List
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
 
 import requests
-from multiwordnet.wordnet import WordNet
-from multiwordnet.db import compile
 
 from MistralInterface import MistralInterface
+from dbRelationCleanup import read_jsonl
 
 
-# Initialize multiwordnet for Italian (keeps original behaviour)
-compile('italian', 'lemma')
-LWN = WordNet('italian')
+@functools.lru_cache(maxsize=1)
+def _get_wordnet():
+    """Compile and load the Italian multiwordnet on first use only."""
+    from multiwordnet.db import compile
+    from multiwordnet.wordnet import WordNet
+
+    compile('italian', 'lemma')
+    return WordNet('italian')
 
 
 PROMPT_TEMPLATE = """
@@ -41,32 +59,45 @@ Segui queste regole:
 - **Non inventare**! Piuttosto, usa "N/A".
 - Restituisci JSON in questo formato:
 
-{{
-    "allegria": {{
-        "morpho": {{
+{
+    "allegria": {
+        "morpho": {
             "a": "allegro",
             "r": "allegramente",
             "v": "rallegrare"
-        }}
-    }},
-    "bontà": {{
-        "morpho": {{
+        }
+    },
+    "bontà": {
+        "morpho": {
             "a": "buono",
             "r": "N/A",
             "v": "N/A"
-        }}
-    }},
+        }
+    },
     ...
-}}
+}
 
 Parole da analizzare:
 {list}
 """
 
+# Accepted noun lemmas: letters (no digits or underscore), spaces and hyphens
+_VALID_LEMMA_RE = re.compile(r"(?:[^\W\d_]| |-)+")
+
+# The template is split once around the {list} placeholder, so no str.format
+# parsing (and no brace escaping) is needed per chunk
+_PROMPT_PREFIX, _PROMPT_SUFFIX = PROMPT_TEMPLATE.split('{list}')
+
 
 def ensure_db(conn: sqlite3.Connection) -> None:
-    """Create tables if they do not exist."""
+    """Configure the connection and create tables if they do not exist."""
     c = conn.cursor()
+    # WAL + synchronous=NORMAL avoid an fsync per commit; readers do not block the writer
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+    c.execute('PRAGMA temp_store=MEMORY')
+    c.execute('PRAGMA cache_size=-65536')
+    c.execute('PRAGMA mmap_size=268435456')
     c.execute(
         '''
     CREATE TABLE IF NOT EXISTS words (
@@ -88,130 +119,269 @@ def ensure_db(conn: sqlite3.Connection) -> None:
     );
     '''
     )
+    c.execute('CREATE INDEX IF NOT EXISTS ix_df_lemma_id ON derived_forms(lemma_id)')
+    # used by dbRelationCleanup's case-insensitive lookups of nouns and derived forms
+    c.execute('CREATE INDEX IF NOT EXISTS ix_words_lemma_nocase ON words(lemma COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS ix_df_form_nocase ON derived_forms(form COLLATE NOCASE)')
+    # one form per (lemma, pos, relation): lets insert_terms upsert instead of
+    # appending duplicates. Databases built before this constraint may already
+    # hold duplicates, so keep only the most recent row of each group first.
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_df_lemma_pos'")
+    if c.fetchone() is None:
+        c.execute(
+            '''
+        DELETE FROM derived_forms WHERE id NOT IN (
+            SELECT MAX(id) FROM derived_forms GROUP BY lemma_id, pos, relation_type
+        )
+        '''
+        )
+        if c.rowcount > 0:
+            print(f"Removed {c.rowcount} duplicate rows from derived_forms "
+                  "(kept the most recent form per noun, pos and relation type)")
+        c.execute('CREATE UNIQUE INDEX ux_df_lemma_pos ON derived_forms(lemma_id, pos, relation_type)')
     conn.commit()
 
 
-def load_paisa_set(path: str = 'lemma-sorted-frequencies-paisa.txt') -> set:
-    """Load the paisà lemma frequency file and return a set of lemmas.
+def load_paisa_set(path: str = 'lemma-sorted-frequencies-paisa.txt') -> frozenset:
+    """Load the paisà lemma frequency file and return a frozenset of lemmas.
 
     Lines starting with '#' or empty lines are ignored.
     If the file cannot be opened an empty set is returned.
     """
     try:
         with open(path, 'r', encoding='utf-8') as fh:
-            lines = fh.read().splitlines()
+            text = fh.read()
     except FileNotFoundError:
         print(f"Warning: paisa file not found at {path}. Continuing with empty set.")
-        return set()
+        return frozenset()
     s = set()
-    for line in lines:
-        if not line or line[0] == '#' or line.strip() == '':
-            continue
-        parts = [p.strip() for p in line.split(",")]
-        if not parts:
+    for line in text.splitlines():
+        if not line or line[0] == '#':
             continue
-        term = parts[0]
-        s.add(term)
-    return s
+        # only the first comma-separated field is needed; partition does not
+        # build a list of all fields
+        term = line.partition(',')[0].strip()
+        if term:
+            s.add(term)
+    return frozenset(s)
 
 
 def build_word_list() -> List[str]:
-    """Extract and filter noun lemmas from the loaded WordNet instance."""
-    word_list: List[str] = []
-    for lemma in LWN.lemmas:
+    """Extract and filter noun lemmas from the Italian WordNet."""
+    word_set: Set[str] = set()
+    for lemma in _get_wordnet().lemmas:
         if getattr(lemma, 'pos', None) == 'n':
             text = getattr(lemma, '_lemma', None)
-            if not isinstance(text, str):
-                continue
-            if any(char.isdigit() for char in text):
-                continue
-            if any(not char.isalnum() and char not in (' ', '-') for char in text):
-                continue
-            word_list.append(text)
-    word_list = sorted(list(set(word_list)))
-    return word_list
-
-
-def process_chunk(chunk: List[str], chunk_index: int, paisa_set: set, mistral: MistralInterface) -> Dict[str, Dict[str, str]]:
+            if isinstance(text, str) and _VALID_LEMMA_RE.fullmatch(text):
+                word_set.add(text)
+    return sorted(word_set)
+
+
+def build_prompt(chunk: List[str]) -> str:
+    """Return the LLM prompt for a chunk of nouns."""
+    return _PROMPT_PREFIX + '\n'.join(chunk) + _PROMPT_SUFFIX
+
+
+def parse_terms(content: str, paisa_set: frozenset) -> Dict[str, Dict[str, str]]:
+    """Parse an LLM JSON answer and validate the derived forms against paisa_set.
+
+    Returns a dict mapping noun -> { 'a': adj or 'N/A', 'v': verb or 'N/A', 'r': adv or 'N/A' }
+    Raises ValueError (json.JSONDecodeError) or AttributeError on malformed answers.
+    """
+    results = json.loads(content)
+    terms: Dict[str, Dict[str, str]] = {}
+    for noun, entry in results.items():
+        a = 'N/A'
+        v = 'N/A'
+        r = 'N/A'
+        if isinstance(entry, dict) and 'morpho' in entry:
+            morpho = entry.get('morpho') or {}
+            a = morpho.get('a', 'N/A')
+            v = morpho.get('v', 'N/A')
+            r = morpho.get('r', 'N/A')
+            if v != 'N/A' and v not in paisa_set:
+                v = 'N/A'
+            if a != 'N/A' and a not in paisa_set:
+                a = 'N/A'
+            if r != 'N/A' and r not in paisa_set:
+                r = 'N/A'
+        terms[noun] = {'a': a, 'v': v, 'r': r}
+    return terms
+
+
+def process_chunk(chunk: List[str], chunk_index: int, paisa_set: frozenset, mistral: MistralInterface) -> Dict[str, Dict[str, str]]:
     """Call the LLM for a chunk of words and validate results against paisa_set.
 
     Returns a dict mapping noun -> { 'a': adj or 'N/A', 'v': verb or 'N/A', 'r': adv or 'N/A' }
     """
-    formatted = PROMPT_TEMPLATE.format(list='\n'.join(chunk))
     print(f"Processing chunk {chunk_index}: {chunk}")
-    resp = mistral.invokeLLM(_prompt=formatted, _format='json_object')
-    terms: Dict[str, Dict[str, str]] = {}
+    resp = mistral.invokeLLM(_prompt=build_prompt(chunk), _format='json_object')
     try:
-        # The original code used json.loads(resp[0])
-        results = json.loads(resp[0]) if isinstance(resp, (list, tuple)) else json.loads(resp)
-        for noun, entry in results.items():
-            a = 'N/A'
-            v = 'N/A'
-            r = 'N/A'
-            if isinstance(entry, dict) and 'morpho' in entry:
-                morpho = entry.get('morpho') or {}
-                a = morpho.get('a', 'N/A')
-                v = morpho.get('v', 'N/A')
-                r = morpho.get('r', 'N/A')
-                if v != 'N/A' and v not in paisa_set:
-                    v = 'N/A'
-                if a != 'N/A' and a not in paisa_set:
-                    a = 'N/A'
-                if r != 'N/A' and r not in paisa_set:
-                    r = 'N/A'
-            terms[noun] = {'a': a, 'v': v, 'r': r}
+        return parse_terms(resp[0], paisa_set)
     except Exception:
         print('Failed to parse JSON response for chunk:', chunk)
-    return terms
+    return {}
+
+
+def write_batch_input(chunks: List[Tuple[int, List[str]]], path: Path) -> None:
+    """Write one batch request per chunk to a JSONL file in Mistral batch format.
+
+    The chunk start index is used as custom_id.
+    """
+    with path.open('w', encoding='utf-8') as fh:
+        for i, chunk in chunks:
+            record = {
+                'custom_id': str(i),
+                'body': {
+                    'temperature': 0.7,
+                    'messages': [{'role': 'user', 'content': build_prompt(chunk)}],
+                    'response_format': {'type': 'json_object'},
+                },
+            }
+            fh.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def consume_batch_output(conn: sqlite3.Connection, path: Path, paisa_set: frozenset) -> None:
+    """Validate and insert the answers contained in a Mistral batch output JSONL."""
+    for out in read_jsonl(path):
+        cid = out.get('custom_id')
+        try:
+            content = out['response']['body']['choices'][0]['message']['content']
+            terms = parse_terms(content, paisa_set)
+        except Exception:
+            print(f'Failed to parse batch response for custom_id={cid}')
+            continue
+        if terms:
+            insert_terms(conn, terms)
 
 
 def insert_terms(conn: sqlite3.Connection, terms: Dict[str, Dict[str, str]]) -> None:
+    """Insert nouns and their derived forms in a single batched transaction."""
+    if not terms:
+        return
     c = conn.cursor()
-    for lemma, forms in terms.items():
-        c.execute('INSERT OR IGNORE INTO words (lemma, pos) VALUES (?, ?)', (lemma, 'n'))
-        c.execute('SELECT id FROM words WHERE lemma = ?', (lemma,))
-        row = c.fetchone()
-        if not row:
-            # This should not happen but guard against it
-            continue
-        lemma_id = row[0]
-        for pos, form in forms.items():
-            if form and form != 'N/A':
-                c.execute(
-                    '''
-                INSERT OR REPLACE INTO derived_forms (lemma_id, form, pos, relation_type)
-                VALUES (?, ?, ?, ?)
-                '''
-                    , (lemma_id, form, pos, 'morphological')
-                )
+    c.executemany('INSERT OR IGNORE INTO words (lemma, pos) VALUES (?, ?)', [(lemma, 'n') for lemma in terms])
+    lemmas = list(terms)
+    c.execute(
+        'SELECT lemma, id FROM words WHERE lemma IN (%s)' % ','.join('?' * len(lemmas)),
+        lemmas,
+    )
+    id_map = dict(c.fetchall())
+    form_rows = [
+        (id_map[lemma], form, pos, 'morphological')
+        for lemma, forms in terms.items()
+        if lemma in id_map
+        for pos, form in forms.items()
+        if form and form != 'N/A'
+    ]
+    c.executemany(
+        '''
+    INSERT INTO derived_forms (lemma_id, form, pos, relation_type)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (lemma_id, pos, relation_type) DO UPDATE SET form = excluded.form
+    ''',
+        form_rows,
+    )
     conn.commit()
 
 
-def main(start: int = 0, chunk_size: int = 5) -> None:
+def main(
+    start: int = 0,
+    chunk_size: int = 5,
+    workers: int = 6,
+    use_cache: bool = True,
+    emit_batch: Optional[str] = None,
+    submit: bool = False,
+    consume_batch: Optional[str] = None,
+) -> None:
     conn = sqlite3.connect('relations_italian.db3')
     ensure_db(conn)
-    print("Loading paisa set and building word list...")
+    print("Loading paisa set...")
     paisa_set = load_paisa_set()
+
+    if consume_batch:
+        print(f"Reading batch output {consume_batch}...")
+        consume_batch_output(conn, Path(consume_batch), paisa_set)
+        conn.close()
+        return
+
+    print("Building word list...")
     word_list = build_word_list()
     print(f'Number of nouns: {len(word_list)}')
 
-    mistral = MistralInterface()
-
-    # iterate chunks starting at `start` index
-    for i in range(start, len(word_list), chunk_size):
-        chunk = word_list[i:i + chunk_size]
-        terms = process_chunk(chunk, i, paisa_set, mistral)
-        if terms:
-            insert_terms(conn, terms)
+    # nouns already stored in the DB were answered in a previous run, so a
+    # restart only pays for the remaining ones; `start` still skips a prefix
+    already = {r[0] for r in conn.execute("SELECT lemma FROM words WHERE pos = 'n'")}
+    # keep each noun's position in the full sorted list, so chunk indices
+    # (log lines and batch custom_ids) can be passed back to --start
+    before = len(word_list[start:])
+    remaining = [(i, w) for i, w in enumerate(word_list) if i >= start and w not in already]
+    print(f'Skipping {before - len(remaining)} already-processed lemmas, {len(remaining)} left')
+
+    chunks = [
+        (remaining[k][0], [w for _, w in remaining[k:k + chunk_size]])
+        for k in range(0, len(remaining), chunk_size)
+    ]
+
+    if emit_batch:
+        write_batch_input(chunks, Path(emit_batch))
+        print(f"Wrote {len(chunks)} batch requests to {emit_batch}")
+        if submit:
+            job_id = MistralInterface(cache_path=None).submitBatch(emit_batch)
+            print(f"Submitted batch job {job_id}")
+        conn.close()
+        return
+
+    mistral = MistralInterface(cache_path='llm_cache.db3' if use_cache else None)
+
+    # LLM calls run in worker threads (MistralInterface's semaphore caps the
+    # in-flight requests); the sqlite connection is only used from this thread.
+    # Only about 2*workers chunks are queued at a time, refilled as they
+    # complete, so an interrupt or a failing insert does not leave the pool
+    # paying for LLM calls whose results would never be stored.
+    pending_chunks = iter(chunks)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        try:
+            pending = {
+                ex.submit(process_chunk, chunk, i, paisa_set, mistral)
+                for i, chunk in islice(pending_chunks, 2 * workers)
+            }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    terms = future.result()
+                    if terms:
+                        insert_terms(conn, terms)
+                    for i, chunk in islice(pending_chunks, 1):
+                        pending.add(ex.submit(process_chunk, chunk, i, paisa_set, mistral))
+        except BaseException:
+            ex.shutdown(wait=False, cancel_futures=True)
+            raise
 
     conn.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Build relations_italian.db3 with derived forms')
-    parser.add_argument('--start', type=int, default=0, help='initial lemma index (default: 0)')
+    parser.add_argument('--start', type=int, default=0, help='index in the sorted noun list to start from, as shown in "Processing chunk N"; nouns already in the DB are skipped anyway (default: 0)')
     parser.add_argument('--chunk-size', type=int, default=5, help='number of lemmas per LLM call (default: 5)')
+    parser.add_argument('--workers', type=int, default=6, help='number of concurrent LLM calls (default: 6)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the LLM response cache')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--emit-batch', metavar='JSONL', help='write the prompts to a Mistral batch input file instead of calling the LLM')
+    mode.add_argument('--consume-batch', metavar='JSONL', help='insert the answers from a Mistral batch output file')
+    parser.add_argument('--submit', action='store_true', help='with --emit-batch, upload the file and start a batch job')
     args = parser.parse_args()
-    main(start=args.start, chunk_size=args.chunk_size)
+    if args.submit and not args.emit_batch:
+        parser.error('--submit requires --emit-batch')
+    main(
+        start=args.start,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        use_cache=not args.no_cache,
+        emit_batch=args.emit_batch,
+        submit=args.submit,
+        consume_batch=args.consume_batch,
+    )
 
 